@@ -5,18 +5,37 @@ DEPLOY_FILE="/var/lib/docker/volumes/profitflip-cicd_deploy-data/_data/deploy.js
 FRONTEND_DIR="/home/profitflip/profitflip-front-visual"
 LOG_FILE="$HOME/deploy.log"
 ORIGINAL_USER=$(who am i | awk '{print $1}')
+CURRENT_USER=$(whoami)
 RETRY_TIMEOUT=300  # 5 minutes in seconds
+STARTUP_TIMEOUT=60  # seconds a new container gets to become ready
+DEBOUNCE_SECONDS=10  # quiet period after the latest push before deploying
+APP_PORT=""  # port probed when the image has no HEALTHCHECK (default: first EXPOSEd port)
+
+# Build with BuildKit so unchanged layers are reused from the previous image
+export DOCKER_BUILDKIT=1
 
 # Function to log messages with more detail
 log() {
     echo "[$(date -u '+%Y-%m-%d %H:%M:%S UTC')] $1" | tee -a "$LOG_FILE"
 }
 
+# Function to log each line read from stdin with a prefix, as it arrives.
+# Timestamps come from the printf builtin and one tee writes the log, so no
+# process is forked per line
+log_stream() {
+    local prefix=$1
+    local line
+    local -x TZ=UTC
+    while IFS= read -r line; do
+        printf '[%(%Y-%m-%d %H:%M:%S UTC)T] %s: %s\n' -1 "$prefix" "$line"
+    done | tee -a "$LOG_FILE"
+}
+
 # Debug function to check file and permissions
 debug_check() {
     log "DEBUG: Checking deploy file and permissions..."
     log "DEBUG: Deploy file path: $DEPLOY_FILE"
-    log "DEBUG: Current user: $(whoami)"
+    log "DEBUG: Current user: $CURRENT_USER"
     log "DEBUG: File exists? $(test -f "$DEPLOY_FILE" && echo "Yes" || echo "No")"
     if [ -f "$DEPLOY_FILE" ]; then
         log "DEBUG: File permissions: $(ls -l "$DEPLOY_FILE")"
@@ -27,16 +46,15 @@ debug_check() {
 
 # Function to check if deployment is needed
 check_deployment() {
-    debug_check
-
     if [ ! -f "$DEPLOY_FILE" ]; then
         log "DEBUG: Deploy file does not exist"
         return 1
     fi
     
     log "DEBUG: Reading status from deploy file..."
-    local status=$(grep -o '"status": *"[^"]*"' "$DEPLOY_FILE" | cut -d'"' -f4)
-    local timestamp=$(grep -o '"timestamp": *"[^"]*"' "$DEPLOY_FILE" | cut -d'"' -f4)
+    # Read every field we need in a single jq call, one value per line
+    local status timestamp
+    { read -r status; read -r timestamp; } < <(jq -r '.status // "", .timestamp // ""' "$DEPLOY_FILE")
     log "DEBUG: Current status: '$status'"
     
     # Calculate time since last update
@@ -45,6 +63,12 @@ check_deployment() {
     local time_diff=$((now - deploy_time))
     
     if [ "$status" = "pending" ]; then
+        # Every push rewrites the timestamp, so waiting for a quiet period
+        # collapses a burst of pushes into one deploy of the latest commit
+        if [ $time_diff -lt $DEBOUNCE_SECONDS ]; then
+            log "DEBUG: Pending deployment is ${time_diff}s old, waiting for further pushes"
+            return 1
+        fi
         log "DEBUG: Found pending deployment"
         return 0
     elif [ "$status" = "failed" ] || [ "$status" = "in_progress" ]; then
@@ -52,8 +76,7 @@ check_deployment() {
         if [ $time_diff -gt $RETRY_TIMEOUT ]; then
             log "DEBUG: Retrying $status deployment after timeout ($time_diff seconds)"
             # Reset status to pending
-            sed -i "s/\"status\": *\"[^\"]*\"/\"status\": \"pending\"/" "$DEPLOY_FILE"
-            sed -i "s/\"last_message\": *\"[^\"]*\"/\"last_message\": \"Retrying after timeout\"/" "$DEPLOY_FILE"
+            update_status "pending" "Retrying after timeout"
             return 0
         else
             local remaining=$((RETRY_TIMEOUT - time_diff))
@@ -65,12 +88,27 @@ check_deployment() {
     return 1
 }
 
-# Function to update deployment status
+# Function to update deployment status. When a commit is given, the entry is
+# only updated if it still describes that commit: a push that arrives
+# mid-deploy overwrites the entry as pending and must stay pending so the
+# next cycle deploys it.
 update_status() {
     local status=$1
     local message=$2
+    local commit=${3:-}
     log "DEBUG: Updating status to: $status ($message)"
     
+    # Leave the file untouched rather than rewriting it when a newer push has
+    # replaced the entry
+    if [ -n "$commit" ]; then
+        local current_commit
+        current_commit=$(jq -r '.commit // ""' "$DEPLOY_FILE")
+        if [ "$current_commit" != "$commit" ]; then
+            log "DEBUG: Deploy file now holds commit $current_commit, not updating"
+            return 0
+        fi
+    fi
+    
     if ! jq --arg status "$status" --arg message "$message" \
         '. + {status: $status, last_message: $message}' "$DEPLOY_FILE" > "${DEPLOY_FILE}.tmp"; then
         log "DEBUG: Failed to update status (jq command failed)"
@@ -85,11 +123,47 @@ update_status() {
     log "DEBUG: Status updated successfully"
 }
 
+# Function to check whether a container accepts TCP connections on its
+# ssl_default address. The port is APP_PORT, or else the first port the
+# image exposes, or else 80
+probe_container_port() {
+    local name=$1
+    local ip ports port
+    IFS='|' read -r ip ports < <(docker inspect -f \
+        '{{(index .NetworkSettings.Networks "ssl_default").IPAddress}}|{{range $p, $_ := .Config.ExposedPorts}}{{$p}} {{end}}' \
+        "$name" 2>/dev/null)
+    port=${APP_PORT:-${ports%%/*}}
+    port=${port:-80}
+    [ -n "$ip" ] && timeout 2 bash -c "exec 3<>/dev/tcp/$ip/$port" 2>/dev/null
+}
+
+# Function to wait until a container is ready: healthy if the image defines
+# a HEALTHCHECK, otherwise running and accepting connections on its port
+wait_for_container() {
+    local name=$1
+    local deadline=$(( $(date +%s) + STARTUP_TIMEOUT ))
+    local state
+    
+    while [ "$(date +%s)" -lt "$deadline" ]; do
+        state=$(docker inspect -f '{{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}{{end}}' "$name" 2>/dev/null)
+        log "DEBUG: Container $name state: $state"
+        case "$state" in
+            "running healthy") return 0 ;;
+            "running starting") ;;  # health check still pending
+            "running ") probe_container_port "$name" && return 0 ;;
+            *) return 1 ;;          # exited, unhealthy or gone
+        esac
+        sleep 1
+    done
+    
+    log "DEBUG: Container $name not ready after ${STARTUP_TIMEOUT}s"
+    return 1
+}
+
 # Function to handle deployment
 handle_deployment() {
-    local repository=$(grep -o '"repository": *"[^"]*"' "$DEPLOY_FILE" | cut -d'"' -f4)
-    local branch=$(grep -o '"branch": *"[^"]*"' "$DEPLOY_FILE" | cut -d'"' -f4)
-    local commit=$(grep -o '"commit": *"[^"]*"' "$DEPLOY_FILE" | cut -d'"' -f4)
+    local repository branch commit
+    { read -r repository; read -r branch; read -r commit; } < <(jq -r '.repository // "", .branch // "", .commit // ""' "$DEPLOY_FILE")
     
     log "DEBUG: Starting deployment process"
     log "DEBUG: Repository: $repository"
@@ -97,52 +171,85 @@ handle_deployment() {
     log "DEBUG: Commit: $commit"
     
     # Update status to in-progress
-    update_status "in_progress" "Starting deployment"
+    update_status "in_progress" "Starting deployment" "$commit"
     
-    # Step 1: Pull latest changes
-    log "DEBUG: Changing to frontend directory: $FRONTEND_DIR"
-    cd "$FRONTEND_DIR" || {
-        log "DEBUG: Failed to change directory. Current directory: $(pwd)"
-        update_status "failed" "Failed to change directory"
+    # Step 1: Pull latest changes. Commands take the frontend directory
+    # explicitly rather than cd-ing, so the monitor loop's cwd never changes
+    log "DEBUG: Frontend directory: $FRONTEND_DIR"
+    if [ ! -d "$FRONTEND_DIR" ]; then
+        log "DEBUG: Frontend directory does not exist"
+        update_status "failed" "Frontend directory not found" "$commit"
         return 1
-    }
-    
-    log "DEBUG: Current directory after cd: $(pwd)"
-    log "DEBUG: Git status before pull:"
-    sudo -u "$ORIGINAL_USER" git status
+    fi
     
+    # Fetch only the pushed branch, without tags, and fast-forward to it.
+    # Output is discarded; stderr is kept only to report a failure
     log "DEBUG: Pulling latest changes from $branch"
-    if ! sudo -u "$ORIGINAL_USER" git pull origin "$branch"; then
-        log "DEBUG: Git pull failed. Git error: $?"
-        update_status "failed" "Failed to pull changes"
+    local git_error
+    if ! git_error=$(sudo -u "$ORIGINAL_USER" git -C "$FRONTEND_DIR" fetch --quiet --no-tags origin "$branch" 2>&1 >/dev/null) ||
+       ! git_error=$(sudo -u "$ORIGINAL_USER" git -C "$FRONTEND_DIR" merge --quiet --ff-only FETCH_HEAD 2>&1 >/dev/null); then
+        log "DEBUG: Git pull failed: $git_error"
+        update_status "failed" "Failed to pull changes" "$commit"
         return 1
     fi
     
     # Step 2: Build Docker image
     log "DEBUG: Building Docker image"
     log "DEBUG: Docker version: $(docker --version)"
-    if ! docker build -t profitflip-frontend .; then
-        log "DEBUG: Docker build failed. Docker error: $?"
-        update_status "failed" "Failed to build Docker image"
+    # Tag the image with the commit actually checked out as well as latest;
+    # the branch may have moved past the queued commit before the fetch.
+    # latest carries the inline cache the next build starts from
+    local built_commit
+    built_commit=$(sudo -u "$ORIGINAL_USER" git -C "$FRONTEND_DIR" rev-parse HEAD)
+    if [ -n "$commit" ] && [ "$built_commit" != "$commit" ]; then
+        log "DEBUG: Branch moved past queued commit $commit, building $built_commit"
+    fi
+    local tags=(-t profitflip-frontend:latest)
+    [ -n "$built_commit" ] && tags+=(-t "profitflip-frontend:$built_commit")
+    # Plain progress output streams one line per build event into the log
+    docker build \
+        --progress=plain \
+        --pull=false \
+        --cache-from profitflip-frontend:latest \
+        --build-arg BUILDKIT_INLINE_CACHE=1 \
+        "${tags[@]}" \
+        "$FRONTEND_DIR" 2>&1 | log_stream "BUILD"
+    local build_status=${PIPESTATUS[0]}
+    if [ "$build_status" -ne 0 ]; then
+        log "DEBUG: Docker build failed. Docker error: $build_status"
+        update_status "failed" "Failed to build Docker image" "$commit"
         return 1
     fi
     
-    # Step 3: Stop and remove old container
-    log "DEBUG: Stopping old container"
-    docker ps -a | grep profitflip-app && {
-        log "DEBUG: Found existing container, stopping and removing"
-        docker stop profitflip-app 2>/dev/null
-        docker rm profitflip-app 2>/dev/null
-    }
-    
-    # Step 4: Start new container
+    # Step 3: Start the new container next to the old one. The network alias
+    # lets the proxy resolve profitflip-app to it before the rename
     log "DEBUG: Starting new container"
+    docker rm -f profitflip-app-new >/dev/null 2>&1
     if ! docker run -d \
-        --name profitflip-app \
+        --name profitflip-app-new \
         --network ssl_default \
+        --network-alias profitflip-app \
         profitflip-frontend; then
         log "DEBUG: Failed to start container. Docker error: $?"
-        update_status "failed" "Failed to start new container"
+        update_status "failed" "Failed to start new container" "$commit"
+        return 1
+    fi
+    
+    if ! wait_for_container profitflip-app-new; then
+        log "DEBUG: New container failed to become ready, keeping old container"
+        docker logs --tail 50 profitflip-app-new 2>&1 | log_stream "DEBUG"
+        docker rm -f profitflip-app-new >/dev/null 2>&1
+        update_status "failed" "New container failed to become ready" "$commit"
+        return 1
+    fi
+    
+    # Step 4: Retire the old container and take over its name. The new one is
+    # already serving, so a forced remove replaces the stop + rm round trips
+    log "DEBUG: Removing old container"
+    docker rm -f profitflip-app >/dev/null 2>&1
+    if ! docker rename profitflip-app-new profitflip-app; then
+        log "DEBUG: Failed to rename new container"
+        update_status "failed" "Failed to rename new container" "$commit"
         return 1
     fi
     
@@ -150,7 +257,7 @@ handle_deployment() {
     docker ps | grep profitflip-app
     
     # Update status to completed
-    update_status "completed" "Deployment successful"
+    update_status "completed" "Deployment successful" "$commit"
     log "DEBUG: Deployment completed successfully"
     return 0
 }
@@ -163,6 +270,7 @@ debug_check
 while true; do
     if check_deployment; then
         log "DEBUG: Starting deployment cycle"
+        debug_check
         handle_deployment
         log "DEBUG: Deployment cycle completed"
     else
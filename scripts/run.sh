@@ -1,11 +1,14 @@
 #!/bin/bash
 
+FRONTEND_DIR="$HOME/profitflip-front-visual"
+STARTUP_TIMEOUT=60  # seconds the new container gets to become ready
+APP_PORT=""  # port probed when the image has no HEALTHCHECK (default: first EXPOSEd port)
+
 # Log the push event
 echo "Received push event at $(date)"
 
-# Get the repository name and branch from the webhook payload
-REPO_NAME=$(echo "$WEBHOOK_PAYLOAD" | jq -r '.repository.name')
-BRANCH=$(echo "$WEBHOOK_PAYLOAD" | jq -r '.ref' | sed 's/refs\/heads\///')
+# Get the repository name and branch from the webhook payload in one parse
+{ read -r REPO_NAME; read -r BRANCH; } < <(jq -r '.repository.name, (.ref | sub("^refs/heads/"; ""))' <<< "$WEBHOOK_PAYLOAD")
 
 echo "Repository: $REPO_NAME"
 echo "Branch: $BRANCH"
@@ -16,39 +19,84 @@ if [ "$REPO_NAME" != "profitflip-front-visual" ]; then
     exit 0
 fi
 
-# Switch to the project directory
-cd ~/profitflip-front-visual || {
-    echo "Failed to change directory to ~/profitflip-front-visual"
+# Commands take the project directory explicitly instead of cd-ing into it
+if [ ! -d "$FRONTEND_DIR" ]; then
+    echo "Project directory does not exist: $FRONTEND_DIR"
     exit 1
-}
+fi
 
 # Pull the latest changes
 echo "Pulling latest changes from $BRANCH"
-git pull origin "$BRANCH" || {
+git -C "$FRONTEND_DIR" pull origin "$BRANCH" || {
     echo "Failed to pull latest changes"
     exit 1
 }
 
-# Build the new Docker image
+# Build the new Docker image with BuildKit, reusing layers from the last build
+# Tag with the commit actually checked out, which may be newer than the pushed one
 echo "Building new Docker image: profitflip-frontend"
-docker build -t profitflip-frontend . || {
+BUILT_COMMIT=$(git -C "$FRONTEND_DIR" rev-parse HEAD)
+TAGS=(-t profitflip-frontend:latest)
+[ -n "$BUILT_COMMIT" ] && TAGS+=(-t "profitflip-frontend:$BUILT_COMMIT")
+DOCKER_BUILDKIT=1 docker build \
+    --pull=false \
+    --cache-from profitflip-frontend:latest \
+    --build-arg BUILDKIT_INLINE_CACHE=1 \
+    "${TAGS[@]}" \
+    "$FRONTEND_DIR" || {
     echo "Failed to build Docker image"
     exit 1
 }
 
-# Stop and remove the current container
-echo "Stopping and removing current profitflip-app container"
-docker stop profitflip-app || true
-docker rm profitflip-app || true
-
-# Start the new container
+# Start the new container alongside the current one; the network alias
+# lets the proxy reach it as profitflip-app before the rename
 echo "Starting new profitflip-app container"
+docker rm -f profitflip-app-new >/dev/null 2>&1
 docker run -d \
-    --name profitflip-app \
+    --name profitflip-app-new \
     --network ssl_default \
+    --network-alias profitflip-app \
     profitflip-frontend || {
     echo "Failed to start new container"
     exit 1
 }
 
+# Wait until it is healthy if the image has a HEALTHCHECK, otherwise until
+# it accepts connections on its ssl_default address
+IFS='|' read -r NEW_IP NEW_PORTS < <(docker inspect -f \
+    '{{(index .NetworkSettings.Networks "ssl_default").IPAddress}}|{{range $p, $_ := .Config.ExposedPorts}}{{$p}} {{end}}' \
+    profitflip-app-new 2>/dev/null)
+PROBE_PORT=${APP_PORT:-${NEW_PORTS%%/*}}
+PROBE_PORT=${PROBE_PORT:-80}
+READY=false
+for _ in $(seq "$STARTUP_TIMEOUT"); do
+    STATE=$(docker inspect -f '{{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}{{end}}' profitflip-app-new 2>/dev/null)
+    case "$STATE" in
+        "running healthy") READY=true; break ;;
+        "running starting") sleep 1 ;;
+        "running ")
+            if [ -n "$NEW_IP" ] && timeout 2 bash -c "exec 3<>/dev/tcp/$NEW_IP/$PROBE_PORT" 2>/dev/null; then
+                READY=true; break
+            fi
+            sleep 1 ;;
+        *) break ;;
+    esac
+done
+
+if [ "$READY" != true ]; then
+    echo "New container failed to become ready (state: $STATE), keeping current container"
+    docker logs --tail 50 profitflip-app-new
+    docker rm -f profitflip-app-new >/dev/null 2>&1
+    exit 1
+fi
+
+# Retire the current container and hand its name to the new one; the new
+# container is already serving, so force-remove instead of stop + rm
+echo "Removing current profitflip-app container"
+docker rm -f profitflip-app >/dev/null 2>&1 || true
+docker rename profitflip-app-new profitflip-app || {
+    echo "Failed to rename new container"
+    exit 1
+}
+
 echo "Deployment completed successfully" 
\ No newline at end of file
@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import unittest
+
+import orjson
+
+SECRET = 'test-secret'
+_deploy_dir = tempfile.TemporaryDirectory()
+os.environ['WEBHOOK_SECRET'] = SECRET
+os.environ['DEPLOY_FILE'] = os.path.join(_deploy_dir.name, 'deploy.json')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import webhook_listener  # noqa: E402
+
+
+def push_payload(commit):
+    return orjson.dumps({
+        'ref': 'refs/heads/main',
+        'after': commit,
+        'repository': {'name': 'profitflip'},
+        'pusher': {'name': 'dev'},
+        'commits': [{'modified': ['src/app.js']}],
+    })
+
+
+class RedeliveryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = webhook_listener.app.test_client()
+        webhook_listener._recent_commits.clear()
+        webhook_listener._deliveries.clear()
+        if os.path.exists(webhook_listener.CONFIG.deploy_file):
+            os.unlink(webhook_listener.CONFIG.deploy_file)
+
+    def deliver(self, delivery_id, commit):
+        body = push_payload(commit)
+        signature = hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post('/webhook', data=body, headers={
+            'X-GitHub-Event': 'push',
+            'X-GitHub-Delivery': delivery_id,
+            'X-Hub-Signature-256': f'sha256={signature}',
+        })
+
+    def read_deploy_file(self):
+        with open(webhook_listener.CONFIG.deploy_file, 'rb') as f:
+            return orjson.loads(f.read())
+
+    def write_status(self, status):
+        entry = self.read_deploy_file()
+        entry['status'] = status
+        with open(webhook_listener.CONFIG.deploy_file, 'wb') as f:
+            f.write(orjson.dumps(entry))
+
+    def test_redelivered_old_push_does_not_replace_newer_push(self):
+        first = self.deliver('d1', 'a' * 40)
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(self.deliver('d2', 'b' * 40).status_code, 202)
+
+        replay = self.deliver('d1', 'a' * 40)
+        self.assertEqual(replay.status_code, 202)
+        self.assertEqual(replay.get_json(), first.get_json())
+        self.assertEqual(self.read_deploy_file()['commit'], 'b' * 40)
+
+    def test_failed_deploy_is_queued_again_on_redelivery(self):
+        self.assertEqual(self.deliver('d1', 'a' * 40).status_code, 202)
+        self.write_status('failed')
+
+        self.assertEqual(self.deliver('d1', 'a' * 40).status_code, 202)
+        entry = self.read_deploy_file()
+        self.assertEqual(entry['commit'], 'a' * 40)
+        self.assertEqual(entry['status'], 'pending')
+
+
+if __name__ == '__main__':
+    unittest.main()
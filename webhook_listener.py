@@ -1,36 +1,101 @@
 import os
-import hmac
 import hashlib
-import json
+import hmac
+import logging
+import ssl
 import traceback
-from flask import Flask, request, abort, jsonify
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from fnmatch import fnmatch
+import orjson
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timezone
+from time import monotonic
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
+DEFAULT_DEPLOY_FILE = '/deploy/deploy.json'
+DEFAULT_DEPLOY_IGNORE_PATHS = ('*.md', '.github/*', 'docs/*', 'LICENSE')
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Listener settings, resolved once from the environment at startup."""
+    # Secret key bytes, encoded once rather than on every verification;
+    # kept out of repr so the config can be logged safely
+    webhook_secret: bytes | None = field(repr=False)
+    # Log level; DEBUG adds per-request headers, payloads and signatures
+    log_level: str = 'INFO'
+    # Pushes whose changed files all match these patterns can't affect the
+    # frontend image, so they are acknowledged without queueing a deploy
+    deploy_ignore_paths: tuple[str, ...] = DEFAULT_DEPLOY_IGNORE_PATHS
+    # Shared-volume file deploy.sh polls for instructions
+    deploy_file: str = DEFAULT_DEPLOY_FILE
+    # Commits queued within this many seconds are not queued again, so
+    # GitHub redeliveries and duplicate push events don't redeploy
+    dedup_window: int = 120
+    # Responses kept for redelivered X-GitHub-Delivery ids
+    delivery_cache_size: int = 1024
+
+    @property
+    def deploy_dir(self):
+        # abspath so a bare file name resolves to the working directory
+        return os.path.dirname(os.path.abspath(self.deploy_file))
+
+    @classmethod
+    def from_env(cls):
+        """Build the configuration from environment variables."""
+        secret = os.getenv('WEBHOOK_SECRET')
+        ignore_paths = os.getenv('DEPLOY_IGNORE_PATHS')
+        return cls(
+            webhook_secret=secret.encode('utf-8') if secret else None,
+            log_level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+            deploy_file=os.getenv('DEPLOY_FILE') or DEFAULT_DEPLOY_FILE,
+            deploy_ignore_paths=(
+                tuple(p.strip() for p in ignore_paths.split(',') if p.strip())
+                if ignore_paths else DEFAULT_DEPLOY_IGNORE_PATHS
+            ),
+        )
+
 # Configuration
-WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
-DEPLOY_FILE = '/deploy/deploy.json'
+CONFIG = Config.from_env()
 
-# Enable debug logging
-app.logger.setLevel('DEBUG')
+# The shared volume directory only needs creating once per process
+os.makedirs(CONFIG.deploy_dir, exist_ok=True)
+
+# Recently queued commit SHAs and when they were queued
+_recent_commits = {}
+_recent_commits_lock = threading.Lock()
+
+# Responses for recently handled X-GitHub-Delivery ids, replayed when
+# GitHub redelivers the same event within the dedup window (bounded, least
+# recently used evicted)
+_deliveries = OrderedDict()
+_deliveries_lock = threading.Lock()
+
+app.logger.setLevel(CONFIG.log_level)
+
+# Signature verification goes through hashlib's OpenSSL backend when it is
+# available; hashlib.sha256 is openssl_sha256 then, and the builtin otherwise
+app.logger.info("HMAC-SHA256 backend: %s (%s)", hashlib.sha256.__name__, ssl.OPENSSL_VERSION)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({
         'status': 'healthy',
-        'webhook_secret_configured': bool(WEBHOOK_SECRET),
-        'deploy_file_exists': os.path.exists(DEPLOY_FILE)
+        'webhook_secret_configured': CONFIG.webhook_secret is not None,
+        'deploy_file_exists': os.path.exists(CONFIG.deploy_file)
     })
 
 def verify_webhook_signature(payload_body, signature_header):
     """Verify GitHub webhook signature."""
-    if not WEBHOOK_SECRET:
+    if CONFIG.webhook_secret is None:
         app.logger.error("WEBHOOK_SECRET not configured")
         raise ValueError("WEBHOOK_SECRET not configured")
     
@@ -48,124 +113,236 @@ def verify_webhook_signature(payload_body, signature_header):
         app.logger.error(f"Invalid hash algorithm: {sha_name}")
         return False
     
-    # Calculate expected signature
-    mac = hmac.new(WEBHOOK_SECRET.encode('utf-8'), msg=payload_body, digestmod=hashlib.sha256)
-    expected_signature = mac.hexdigest()
+    # A hex SHA-256 digest is always 64 characters; reject anything else
+    # before touching the payload
+    if len(signature) != 64:
+        app.logger.error(f"Invalid signature length: {len(signature)}")
+        return False
     
-    app.logger.info(f"Received signature: {signature}")
-    app.logger.info(f"Expected signature: {expected_signature}")
-    app.logger.info(f"Secret being used: {WEBHOOK_SECRET}")
-    app.logger.info(f"Payload length: {len(payload_body)} bytes")
+    try:
+        received_digest = bytes.fromhex(signature)
+    except ValueError:
+        app.logger.error(f"Signature is not valid hex: {signature}")
+        return False
     
-    return hmac.compare_digest(expected_signature, signature)
+    app.logger.debug("Received signature: %s", signature)
+    app.logger.debug("Payload length: %d bytes", len(payload_body))
+    
+    # hmac.digest is a single OpenSSL call; compare the raw 32-byte digests
+    # in constant time
+    expected_digest = hmac.digest(CONFIG.webhook_secret, payload_body, 'sha256')
+    return hmac.compare_digest(expected_digest, received_digest)
+
+def queued_deploy_failed(commit):
+    """Check whether the deploy file still holds this commit with a failed status."""
+    try:
+        with open(CONFIG.deploy_file, 'rb') as f:
+            entry = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return False
+    return (isinstance(entry, dict) and entry.get('commit') == commit
+            and entry.get('status') == 'failed')
+
+def commit_recently_queued(sha):
+    """Check whether a commit was queued within the dedup window and hasn't failed."""
+    now = monotonic()
+    with _recent_commits_lock:
+        for queued_sha, queued_at in list(_recent_commits.items()):
+            if now - queued_at > CONFIG.dedup_window:
+                del _recent_commits[queued_sha]
+        if sha not in _recent_commits:
+            return False
+    # Only a failed deploy may be queued again; a commit that a newer push
+    # replaced must not overwrite it
+    return not queued_deploy_failed(sha)
+
+def remember_queued_commit(sha):
+    """Record a commit as queued for the dedup window."""
+    with _recent_commits_lock:
+        _recent_commits[sha] = monotonic()
+
+def delivered_response(delivery_id):
+    """Return the cached (body, status) for a delivery that can be replayed, or None."""
+    with _deliveries_lock:
+        cached = _deliveries.get(delivery_id)
+        if cached is None:
+            return None
+        body, status, commit, handled_at = cached
+        if monotonic() - handled_at > CONFIG.dedup_window:
+            del _deliveries[delivery_id]
+            return None
+        _deliveries.move_to_end(delivery_id)
+    # If the deploy this delivery queued has failed, a manual redelivery must
+    # queue it again; if a newer push replaced it, replaying keeps the old
+    # event from overwriting that push
+    if commit and queued_deploy_failed(commit):
+        return None
+    return body, status
+
+def remember_delivery(delivery_id, body, status, commit=None):
+    """Cache the response for a delivery, with the commit it queued if any."""
+    with _deliveries_lock:
+        _deliveries[delivery_id] = (body, status, commit, monotonic())
+        _deliveries.move_to_end(delivery_id)
+        if len(_deliveries) > CONFIG.delivery_cache_size:
+            _deliveries.popitem(last=False)
+
+def has_deployable_changes(payload):
+    """Check whether a push touches any file outside DEPLOY_IGNORE_PATHS."""
+    # A deleted branch has nothing to deploy
+    if payload.get('deleted'):
+        return False
+    # Forced pushes and new branches may not list every changed file, so
+    # they always deploy
+    commits = payload.get('commits') or []
+    if payload.get('forced') or payload.get('created') or not commits:
+        return True
+    for commit in commits:
+        for key in ('added', 'modified', 'removed'):
+            for path in commit.get(key) or ():
+                if not any(fnmatch(path, pattern) for pattern in CONFIG.deploy_ignore_paths):
+                    return True
+    return False
 
 def write_deploy_instruction(payload):
     """Write deployment instructions to shared volume."""
     try:
-        # Log the current state of the file
-        app.logger.info("Checking current deploy file state...")
-        if os.path.exists(DEPLOY_FILE):
-            try:
-                with open(DEPLOY_FILE, 'r') as f:
-                    current_data = json.load(f)
-                app.logger.info(f"Current deploy file content: {json.dumps(current_data, indent=2)}")
-            except Exception as e:
-                app.logger.error(f"Error reading current deploy file: {str(e)}")
-        else:
-            app.logger.info("Deploy file does not exist yet")
+        # Log the current state of the file; reading it is only worth the
+        # I/O when debugging
+        if app.logger.isEnabledFor(logging.DEBUG):
+            if os.path.exists(CONFIG.deploy_file):
+                try:
+                    with open(CONFIG.deploy_file, 'rb') as f:
+                        app.logger.debug("Current deploy file content: %s", f.read().decode())
+                except Exception as e:
+                    app.logger.error(f"Error reading current deploy file: {str(e)}")
+            else:
+                app.logger.debug("Deploy file does not exist yet")
 
         # Create deployment instruction
+        repository = payload.get('repository') or {}
+        pusher = payload.get('pusher') or {}
+        ref = payload.get('ref') or ''
         deploy_data = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'repository': payload.get('repository', {}).get('name'),
-            'branch': payload.get('ref', '').replace('refs/heads/', ''),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'repository': repository.get('name'),
+            'branch': ref.removeprefix('refs/heads/'),
             'commit': payload.get('after'),
-            'author': payload.get('pusher', {}).get('name'),
+            'author': pusher.get('name'),
             'status': 'pending'
         }
         
-        app.logger.info(f"Created new deploy data: {json.dumps(deploy_data, indent=2)}")
+        app.logger.debug("Created new deploy data: %s", deploy_data)
         
-        # Ensure directory exists
-        deploy_dir = os.path.dirname(DEPLOY_FILE)
-        app.logger.info(f"Ensuring directory exists: {deploy_dir}")
-        os.makedirs(deploy_dir, exist_ok=True)
-        
-        # Check directory permissions
-        app.logger.info(f"Directory permissions: {oct(os.stat(deploy_dir).st_mode)}")
-        
-        # Write deployment instruction
+        # Write deployment instruction to a temp file in the same directory
+        # and rename it over the deploy file, so deploy.sh never sees a partial file
         app.logger.info("Writing new deploy data...")
-        with open(DEPLOY_FILE, 'w') as f:
-            json.dump(deploy_data, f, indent=2)
-            
-        # Verify the write
-        app.logger.info("Verifying write operation...")
-        if os.path.exists(DEPLOY_FILE):
-            with open(DEPLOY_FILE, 'r') as f:
-                written_data = json.load(f)
-            app.logger.info(f"Written deploy file content: {json.dumps(written_data, indent=2)}")
-            if written_data != deploy_data:
-                app.logger.error("Written data does not match intended data!")
-                return False
-        else:
-            app.logger.error("Deploy file does not exist after write!")
-            return False
+        data = orjson.dumps(deploy_data, option=orjson.OPT_INDENT_2)
+        fd, tmp_path = tempfile.mkstemp(dir=CONFIG.deploy_dir, prefix='.deploy-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), 0o644)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, CONFIG.deploy_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
             
-        app.logger.info(f"Successfully wrote deployment instructions to {DEPLOY_FILE}")
+        app.logger.info(f"Successfully wrote deployment instructions to {CONFIG.deploy_file}")
         return True
     except Exception as e:
         app.logger.error(f"Failed to write deployment instructions: {str(e)}")
         app.logger.error(f"Traceback:\n{traceback.format_exc()}")
         app.logger.error(f"Current working directory: {os.getcwd()}")
-        app.logger.error(f"Deploy file path: {os.path.abspath(DEPLOY_FILE)}")
+        app.logger.error(f"Deploy file path: {os.path.abspath(CONFIG.deploy_file)}")
         return False
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    # Only push events trigger deploys; acknowledge everything else before
+    # reading the body or verifying the signature
+    event_type = request.headers.get('X-GitHub-Event')
+    if event_type != 'push':
+        app.logger.debug("Ignoring non-push event: %s", event_type)
+        return 'OK', 200
+
+    # A redelivered event gets the original response without re-verifying
+    # or re-queueing anything
+    delivery_id = request.headers.get('X-GitHub-Delivery')
+    cached = delivered_response(delivery_id) if delivery_id else None
+    if cached is not None:
+        app.logger.info("Delivery %s already handled, replaying response", delivery_id)
+        body, status = cached
+        return jsonify(body), status
+
     try:
         # Log headers for debugging
-        app.logger.info("Received headers:")
-        for header, value in request.headers.items():
-            app.logger.info(f"{header}: {value}")
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Received headers: %s", dict(request.headers))
 
         # Get the raw payload body for signature verification
         payload_body = request.get_data()
-        app.logger.info(f"Raw payload: {payload_body.decode('utf-8')}")
         
         # Verify webhook signature
         signature_header = request.headers.get('X-Hub-Signature-256')
         if not verify_webhook_signature(payload_body, signature_header):
             app.logger.error("Invalid webhook signature")
-            abort(401)
-        
-        # Process the webhook
-        event_type = request.headers.get('X-GitHub-Event')
+            return jsonify({
+                'status': 'error',
+                'message': 'Invalid signature'
+            }), 401
         
-        # Parse JSON payload
+        # Parse JSON payload from the body already read for verification
         try:
-            payload = request.get_json()
-        except Exception as e:
+            payload = orjson.loads(payload_body)
+        except orjson.JSONDecodeError as e:
             app.logger.error(f"Failed to parse JSON payload: {e}")
             app.logger.error(f"Traceback:\n{traceback.format_exc()}")
             return 'Invalid JSON payload', 400
         
-        # Only process push events
-        if event_type != 'push':
-            app.logger.info(f"Ignoring non-push event: {event_type}")
-            return 'OK', 200
-        
         # Log the event
-        app.logger.info(f"Received push event for repository: {payload.get('repository', {}).get('name')}")
-        app.logger.info(f"Payload: {json.dumps(payload, indent=2)}")
+        app.logger.info(
+            "Received push event for repository: %s (commit %s)",
+            (payload.get('repository') or {}).get('name'), (payload.get('after') or '')[:8]
+        )
+        app.logger.debug("Payload: %s", payload)
+        
+        commit = payload.get('after')
+        if commit and commit_recently_queued(commit):
+            app.logger.info("Commit %s already queued, skipping", commit[:8])
+            body, status = {
+                'status': 'ignored',
+                'message': 'Commit already queued'
+            }, 200
+            if delivery_id:
+                remember_delivery(delivery_id, body, status, commit)
+            return jsonify(body), status
         
-        # Write deployment instructions
+        if not has_deployable_changes(payload):
+            app.logger.info("Commit %s changes no deployable files, skipping", (commit or '')[:8])
+            body, status = {
+                'status': 'ignored',
+                'message': 'No deployable changes'
+            }, 200
+            if delivery_id:
+                remember_delivery(delivery_id, body, status)
+            return jsonify(body), status
+        
+        # Write deployment instructions; deploy.sh on the host picks them up,
+        # so the delivery is acknowledged without waiting for the deploy
         if write_deploy_instruction(payload):
             app.logger.info("Successfully wrote deployment instructions")
-            return jsonify({
-                'status': 'success',
-                'message': 'Deployment instructions written successfully'
-            }), 200
+            if commit:
+                remember_queued_commit(commit)
+            body, status = {
+                'status': 'accepted',
+                'message': 'Deployment queued'
+            }, 202
+            if delivery_id:
+                remember_delivery(delivery_id, body, status, commit)
+            return jsonify(body), status
         else:
             app.logger.error("Failed to write deployment instructions")
             return jsonify({
@@ -182,4 +359,5 @@ def webhook():
         }), 500
 
 if __name__ == '__main__':
+    # Local development only; the container runs the app under gunicorn
     app.run(host='0.0.0.0', port=8000) 